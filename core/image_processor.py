@@ -2,9 +2,12 @@
 图像处理核心模块 - 包含水印算法和安全检查
 """
 
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from io import BytesIO
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import BinaryIO, Dict, Optional, Tuple, Union
 
 from PIL import Image
 from astrbot.api import logger
@@ -23,29 +26,74 @@ class ImageProcessor:
     ALPHA_THRESHOLD = 10
     DOUBAO_SIZE_RATIO = 0.13
     DOUBAO_MARGIN_RATIO = 0.03
-
-    def __init__(self, watermark_dir: Path):
+    DOUBAO_WIDTH_STEP = 8
+    RESIZE_REDUCING_GAP = 3.0
+    OUTPUT_FORMAT = "PNG"
+    OUTPUT_COMPRESS_LEVEL = 3
+    PREPARED_CACHE_SIZE = 16
+    GEMINI_LARGE_WATERMARK = "gemini_96px.png"
+    GEMINI_SMALL_WATERMARK = "gemini_48px.png"
+    GEMINI_WATERMARKS = (GEMINI_LARGE_WATERMARK, GEMINI_SMALL_WATERMARK)
+    DOUBAO_WATERMARK = "doubao.png"
+
+    def __init__(self, watermark_dir: Path, gemini_opacity: Optional[float] = None):
         self.watermark_dir = watermark_dir
         self._watermark_cache = {}
-
-    def _get_watermark_path(self, filename: str) -> Path:
-        return self.watermark_dir / filename
+        self._prepared_cache: "OrderedDict[Tuple[str, int, int, int], Image.Image]" = OrderedDict()
+        self._prepared_cache_lock = threading.Lock()
+        # 启动时按配置透明度生成的固定尺寸水印，单独存放，不参与_prepared_cache的淘汰
+        self._baked_watermarks: Dict[Tuple[str, int, int, int], Image.Image] = {}
+        self._watermark_paths: Dict[str, Path] = {}
+        self._scan_watermark_dir()
+        self._preload_watermarks(gemini_opacity)
+
+    def _preload_watermarks(self, gemini_opacity: Optional[float]):
+        """启动时预加载水印素材；Gemini水印尺寸固定，可直接按配置透明度预先生成"""
+        for filename in (*self.GEMINI_WATERMARKS, self.DOUBAO_WATERMARK):
+            self.load_watermark(filename)
+        if gemini_opacity is None:
+            return
+        for filename in self.GEMINI_WATERMARKS:
+            watermark = self._watermark_cache.get(filename)
+            if watermark is not None:
+                key = self._prepared_key(filename, watermark.size, gemini_opacity)
+                self._baked_watermarks[key] = self._resize_with_opacity(watermark, watermark.size, gemini_opacity)
+
+    def _scan_watermark_dir(self):
+        """启动时扫描一次水印目录，记录文件名到路径的映射"""
+        try:
+            self._watermark_paths = {p.name: p for p in self.watermark_dir.iterdir() if p.is_file()}
+        except OSError as e:
+            logger.warning(f"扫描水印目录失败 {self.watermark_dir}: {e}")
+            self._watermark_paths = {}
+
+    def _get_watermark_path(self, filename: str) -> Optional[Path]:
+        watermark_path = self._watermark_paths.get(filename)
+        if watermark_path is None:
+            # 启动后新增的文件才需要访问文件系统
+            watermark_path = self.watermark_dir / filename
+            if not watermark_path.exists():
+                return None
+            self._watermark_paths[filename] = watermark_path
+        return watermark_path
 
     def load_watermark(self, filename: str) -> Optional[Image.Image]:
+        """加载水印素材；返回的是缓存中的原图，调用方不可修改（resize会生成新图像）"""
         if filename in self._watermark_cache:
-            return self._watermark_cache[filename].copy()
+            return self._watermark_cache[filename]
 
         watermark_path = self._get_watermark_path(filename)
-        if watermark_path.exists():
+        if watermark_path is not None:
             try:
-                watermark = Image.open(watermark_path).convert("RGBA")
-                self._watermark_cache[filename] = watermark.copy()
-                return watermark.copy()
+                with Image.open(watermark_path) as source:
+                    watermark = source.convert("RGBA")
+                self._watermark_cache[filename] = watermark
+                return watermark
             except Exception as e:
                 logger.error(f"加载水印失败 {filename}: {e}")
                 return None
         else:
-            logger.error(f"水印文件不存在: {watermark_path}")
+            logger.error(f"水印文件不存在: {self.watermark_dir / filename}")
             return None
 
     def check_image_safety(self, img: Image.Image) -> Tuple[bool, str]:
@@ -56,27 +104,87 @@ class ImageProcessor:
             logger.warning(f"处理大图像: {pixels}像素 ({img.width}x{img.height})")
         return True, ""
 
-    def preprocess_image(self, image_data: bytes) -> Optional[Image.Image]:
+    def preprocess_image(self, image_data: Union[bytes, BinaryIO]) -> Optional[Image.Image]:
         try:
-            img = Image.open(BytesIO(image_data))
-            if img.mode not in ("RGB", "RGBA"):
-                img = img.convert("RGB")
+            if isinstance(image_data, (bytes, bytearray)):
+                image_data = BytesIO(image_data)
+            img = Image.open(image_data)
+            # Image.open只读取文件头，先做尺寸检查，超限图片无需解码像素
             is_safe, error_msg = self.check_image_safety(img)
             if not is_safe:
                 logger.error(f"图片安全检查失败: {error_msg}")
                 return None
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGB")
             return img
         except Exception as e:
             logger.error(f"图片预处理失败: {e}")
             return None
 
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _opacity_lut(opacity: float, threshold: int) -> Tuple[int, ...]:
+        """生成透明度查找表，同一(透明度, 阈值)只计算一次"""
+        level = int(255 * opacity)
+        return tuple(level if v > threshold else 0 for v in range(256))
+
     def _apply_opacity(self, watermark: Image.Image, opacity: float) -> Image.Image:
         """应用透明度"""
         alpha = watermark.getchannel("A")
-        new_alpha = alpha.point(lambda v: int(255 * opacity) if v > self.ALPHA_THRESHOLD else 0)
+        new_alpha = alpha.point(self._opacity_lut(opacity, self.ALPHA_THRESHOLD))
         watermark.putalpha(new_alpha)
         return watermark
 
+    @staticmethod
+    def _prepared_key(watermark_name: str, size: Tuple[int, int], opacity: float) -> Tuple[str, int, int, int]:
+        return watermark_name, size[0], size[1], round(opacity * 1000)
+
+    def _resize_with_opacity(self, watermark: Image.Image, size: Tuple[int, int], opacity: float) -> Image.Image:
+        # reducing_gap: 先用reduce()按整数倍做廉价的box缩小，再对剩余部分做Lanczos
+        prepared = watermark.resize(size, Image.Resampling.LANCZOS, reducing_gap=self.RESIZE_REDUCING_GAP)
+        if prepared.mode != "RGBA":
+            prepared = prepared.convert("RGBA")
+        return self._apply_opacity(prepared, opacity)
+
+    def _prepare_watermark(self, watermark: Image.Image, size: Tuple[int, int], opacity: float,
+                           watermark_name: Optional[str] = None) -> Image.Image:
+        """缩放并应用透明度，按(文件名, 宽, 高, 透明度)缓存结果；缓存的图像只读不可修改"""
+        key = None
+        if watermark_name:
+            key = self._prepared_key(watermark_name, size, opacity)
+            cached = self._baked_watermarks.get(key)
+            if cached is None:
+                cached = self._prepared_cache.get(key)
+            if cached is not None:
+                return cached
+
+        prepared = self._resize_with_opacity(watermark, size, opacity)
+
+        if key is not None:
+            with self._prepared_cache_lock:
+                self._prepared_cache[key] = prepared
+                if len(self._prepared_cache) > self.PREPARED_CACHE_SIZE:
+                    self._prepared_cache.popitem(last=False)
+        return prepared
+
+    def _composite_watermark(self, result: Image.Image, watermark: Image.Image, x: int, y: int) -> Image.Image:
+        """只在水印区域内做alpha合成（Pillow-SIMD下走向量化的AlphaComposite）"""
+        wm_width, wm_height = watermark.size
+        box = (x, y, x + wm_width, y + wm_height)
+        region = result.crop(box)
+        if region.mode != "RGBA":
+            region = region.convert("RGBA")
+        composited = Image.alpha_composite(region, watermark)
+        if composited.mode != result.mode:
+            composited = composited.convert(result.mode)
+        result.paste(composited, (x, y))
+        return result
+
+    @staticmethod
+    def _copy_as_rgb(image: Image.Image) -> Image.Image:
+        """得到可修改的RGB副本，RGB图像直接复制，避免整图转RGBA再转回"""
+        return image.copy() if image.mode == "RGB" else image.convert("RGB")
+
     def _calculate_gemini_position(self, img_width: int, img_height: int, watermark: Image.Image) -> Tuple[int, int]:
         wm_width, wm_height = watermark.size
         if img_width > self.LARGE_IMAGE_THRESHOLD and img_height > self.LARGE_IMAGE_THRESHOLD:
@@ -87,17 +195,14 @@ class ImageProcessor:
         y = img_height - margin - wm_height
         return x, y
 
-    def apply_gemini_watermark(self, image: Image.Image, watermark: Image.Image, opacity: float = 0.25) -> Optional[Image.Image]:
+    def apply_gemini_watermark(self, image: Image.Image, watermark: Image.Image, opacity: float = 0.25,
+                               watermark_name: Optional[str] = None) -> Optional[Image.Image]:
         is_safe, error_msg = self.check_image_safety(image)
         if not is_safe:
             logger.error(f"图片安全检查失败: {error_msg}")
             return None
 
-        result = image.copy()
-        if result.mode != "RGBA":
-            result = result.convert("RGBA")
-
-        width, height = result.size
+        width, height = image.size
         wm_width, wm_height = watermark.size
         x, y = self._calculate_gemini_position(width, height, watermark)
 
@@ -105,33 +210,24 @@ class ImageProcessor:
             logger.warning("水印尺寸超过图片尺寸，跳过处理")
             return image.convert("RGB")
 
-        resized_watermark = watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
-        if resized_watermark.mode != "RGBA":
-            resized_watermark = resized_watermark.convert("RGBA")
+        resized_watermark = self._prepare_watermark(watermark, (wm_width, wm_height), opacity, watermark_name)
 
-        resized_watermark = self._apply_opacity(resized_watermark, opacity)
+        result = self._copy_as_rgb(image)
+        return self._composite_watermark(result, resized_watermark, x, y)
 
-        result.paste(resized_watermark, (x, y), resized_watermark)
-        return result.convert("RGB")
-
-    def _calculate_doubao_size(self, img_width: int, img_height: int) -> Tuple[int, int]:
+    def _doubao_geometry(self, img_width: int, img_height: int) -> Tuple[int, int, int, int]:
+        """一次算出豆包水印的尺寸和位置: (宽, 高, x, y)"""
         wm_width = int(img_width * self.DOUBAO_SIZE_RATIO)
+        # 宽度对齐到步长，让相近尺寸的图片命中同一个缓存的水印
+        if wm_width >= self.DOUBAO_WIDTH_STEP:
+            wm_width = round(wm_width / self.DOUBAO_WIDTH_STEP) * self.DOUBAO_WIDTH_STEP
         wm_height = int(wm_width / DOUBAN_ASPECT_RATIO)
-        return wm_width, wm_height
-
-    def _calculate_doubao_margin(self, img_width: int, img_height: int) -> Tuple[int, int]:
         margin_x = int(img_width * self.DOUBAO_MARGIN_RATIO)
         margin_y = int(img_height * self.DOUBAO_MARGIN_RATIO)
-        return margin_x, margin_y
+        return wm_width, wm_height, img_width - margin_x - wm_width, img_height - margin_y - wm_height
 
-    def _calculate_doubao_position(self, img_width: int, img_height: int, wm_width: int, wm_height: int) -> Tuple[int, int]:
-        margin_right = int(img_width * self.DOUBAO_MARGIN_RATIO)
-        margin_bottom = int(img_height * self.DOUBAO_MARGIN_RATIO)
-        x = img_width - margin_right - wm_width
-        y = img_height - margin_bottom - wm_height
-        return x, y
-
-    def apply_doubao_watermark(self, image: Image.Image, watermark: Optional[Image.Image], opacity: float = 0.7) -> Optional[Image.Image]:
+    def apply_doubao_watermark(self, image: Image.Image, watermark: Optional[Image.Image], opacity: float = 0.7,
+                               watermark_name: Optional[str] = None) -> Optional[Image.Image]:
         if watermark is None:
             logger.error("水印素材为空")
             return None
@@ -141,23 +237,15 @@ class ImageProcessor:
             logger.error(f"图片安全检查失败: {error_msg}")
             return None
 
-        result = image.copy()
-        if result.mode != "RGBA":
-            result = result.convert("RGBA")
-
-        wm_width, wm_height = self._calculate_doubao_size(image.width, image.height)
-
-        resized_watermark = watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
-        if resized_watermark.mode != "RGBA":
-            resized_watermark = resized_watermark.convert("RGBA")
+        wm_width, wm_height, x, y = self._doubao_geometry(image.width, image.height)
 
-        resized_watermark = self._apply_opacity(resized_watermark, opacity)
+        resized_watermark = self._prepare_watermark(watermark, (wm_width, wm_height), opacity, watermark_name)
 
-        x, y = self._calculate_doubao_position(image.width, image.height, wm_width, wm_height)
-        result.paste(resized_watermark, (x, y), resized_watermark)
-        return result.convert("RGB")
+        result = self._copy_as_rgb(image)
+        return self._composite_watermark(result, resized_watermark, x, y)
 
-    def generate_output_path(self, data_dir: Path, source_info: str, watermark_type: str) -> Path:
-        from ..utils.file_utils import FileUtils
-        filename = FileUtils.generate_filename(source_info, f"watermark_{watermark_type}")
-        return data_dir / filename
+    def encode_image(self, image: Image.Image) -> bytes:
+        """在内存中编码结果图片，不落盘"""
+        buffer = BytesIO()
+        image.save(buffer, format=self.OUTPUT_FORMAT, compress_level=self.OUTPUT_COMPRESS_LEVEL)
+        return buffer.getvalue()
@@ -2,18 +2,17 @@
 仿制AI水印插件主入口模块
 """
 
+import asyncio
 from pathlib import Path
 from typing import Optional
 
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.core.star.filter.event_message_type import EventMessageType
-from astrbot.api.star import Context, Star, StarTools, register
+from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 from astrbot.api import message_components as Comp
 
-from .constants import PLUGIN_NAME
 from .utils.network_utils import NetworkUtils
-from .utils.file_utils import FileUtils
 from .core.image_processor import ImageProcessor
 
 
@@ -31,8 +30,6 @@ class FakeAIWatermarkPlugin(Star):
         super().__init__(context)
         self.plugin_dir = Path(__file__).parent
         self.watermark_dir = self.plugin_dir / "watermark_PNG"
-        self.data_dir = StarTools.get_data_dir(PLUGIN_NAME)
-        self.data_dir.mkdir(parents=True, exist_ok=True)
 
         try:
             self.gemini_opacity = context.config.get("gemini_opacity", 0.25)
@@ -43,7 +40,7 @@ class FakeAIWatermarkPlugin(Star):
             self.doubao_opacity = 0.7
 
         self.network_utils = NetworkUtils(timeout=30, max_size=10 * 1024 * 1024)
-        self.image_processor = ImageProcessor(self.watermark_dir)
+        self.image_processor = ImageProcessor(self.watermark_dir, gemini_opacity=self.gemini_opacity)
 
         logger.info(f"仿制AI水印插件已加载 - Gemini透明度: {self.gemini_opacity}, 豆包透明度: {self.doubao_opacity}")
 
@@ -90,7 +87,6 @@ class FakeAIWatermarkPlugin(Star):
         return None
 
     async def _process_watermark(self, event: AstrMessageEvent, watermark_type: str):
-        output_path = None
         try:
             image_url = self._extract_image_from_event(event)
             if not image_url:
@@ -98,34 +94,43 @@ class FakeAIWatermarkPlugin(Star):
                 return
 
             image_data = await self.network_utils.download_image(image_url)
-            if not image_data:
+            if image_data is None:
                 yield event.plain_result("❌ 图片下载失败或URL不安全")
                 return
 
-            image = self.image_processor.preprocess_image(image_data)
+            # Pillow的解码/缩放/合成/编码都是CPU密集操作，放到线程池里避免阻塞事件循环
+            image = await asyncio.to_thread(self.image_processor.preprocess_image, image_data)
             if not image:
                 yield event.plain_result("❌ 图片处理失败")
                 return
 
             if watermark_type == "gemini":
                 if image.width > 1024 and image.height > 1024:
-                    watermark = self.image_processor.load_watermark("gemini_96px.png")
+                    watermark_name = ImageProcessor.GEMINI_LARGE_WATERMARK
                 else:
-                    watermark = self.image_processor.load_watermark("gemini_48px.png")
+                    watermark_name = ImageProcessor.GEMINI_SMALL_WATERMARK
+                watermark = await asyncio.to_thread(self.image_processor.load_watermark, watermark_name)
 
                 if not watermark:
                     yield event.plain_result("❌ 水印素材加载失败")
                     return
 
-                result = self.image_processor.apply_gemini_watermark(image, watermark, self.gemini_opacity)
+                result = await asyncio.to_thread(
+                    self.image_processor.apply_gemini_watermark,
+                    image, watermark, self.gemini_opacity, watermark_name=watermark_name
+                )
             else:
-                watermark = self.image_processor.load_watermark("doubao.png")
+                watermark_name = ImageProcessor.DOUBAO_WATERMARK
+                watermark = await asyncio.to_thread(self.image_processor.load_watermark, watermark_name)
 
                 if not watermark:
                     yield event.plain_result("❌ 水印素材加载失败")
                     return
 
-                result = self.image_processor.apply_doubao_watermark(image, watermark, self.doubao_opacity)
+                result = await asyncio.to_thread(
+                    self.image_processor.apply_doubao_watermark,
+                    image, watermark, self.doubao_opacity, watermark_name=watermark_name
+                )
 
                 if not result:
                     yield event.plain_result("❌ 水印应用失败")
@@ -135,18 +140,14 @@ class FakeAIWatermarkPlugin(Star):
                 yield event.plain_result("❌ 水印处理失败")
                 return
 
-            output_path = self.image_processor.generate_output_path(self.data_dir, "user_image", watermark_type)
-            result.save(str(output_path), quality=95)
-            logger.info(f"水印处理完成: {output_path}")
+            image_bytes = await asyncio.to_thread(self.image_processor.encode_image, result)
+            logger.info(f"水印处理完成: {watermark_type}, {len(image_bytes)} bytes")
 
-            yield event.chain_result([Comp.Image(file=str(output_path))])
+            yield event.chain_result([Comp.Image.fromBytes(image_bytes)])
 
         except Exception as e:
             logger.error(f"水印处理异常: {e}", exc_info=True)
             yield event.plain_result(f"❌ 处理失败: {str(e)}")
-        finally:
-            if output_path and output_path.exists():
-                FileUtils.cleanup_file(output_path)
 
     async def cleanup(self):
         await self.network_utils.cleanup()
@@ -13,11 +13,14 @@ from typing import Optional, Tuple
 from urllib.parse import urlparse, parse_qs
 from astrbot.api import logger
 
+_EXT_RE = re.compile(r"\.([a-zA-Z0-9]+)$")
+_URL_SPECIAL_CHARS = ("?", "#", ";")
+
 
 class FileUtils:
     """文件处理工具类"""
 
-    SUPPORTED_FORMATS = {".png", ".jpg", ".jpeg", ".bmp", ".webp", ".gif"}
+    SUPPORTED_FORMATS = frozenset({".png", ".jpg", ".jpeg", ".bmp", ".webp", ".gif"})
     DEFAULT_IMAGE_SIZE_LIMIT = 10 * 1024 * 1024
     DEFAULT_GIF_SIZE_LIMIT = 15 * 1024 * 1024
 
@@ -26,24 +29,37 @@ class FileUtils:
 
     URL_LENGTH_THRESHOLD = 1000
 
-    MAGIC_BYTES = {
-        "gif": ([b"GIF87a", b"GIF89a"], 6),
-        "png": (b"\x89PNG\r\n\x1a\n", 8),
-        "jpeg": (b"\xff\xd8\xff", 3),
-        "webp": (b"RIFF", 4, b"WEBP", 8),
-        "bmp": (b"BM", 2),
-    }
+    # (文件头前缀, 扩展名, 附加校验(偏移, 内容))，按常见程度排序
+    MAGIC_BYTES = (
+        (b"\xff\xd8\xff", ".jpg", None),
+        (b"\x89PNG\r\n\x1a\n", ".png", None),
+        ((b"GIF87a", b"GIF89a"), ".gif", None),
+        (b"RIFF", ".webp", (8, b"WEBP")),
+        (b"BM", ".bmp", None),
+    )
 
     @staticmethod
     def get_file_extension(url_or_path: str) -> Optional[str]:
         try:
+            # 快速路径：不含查询/片段/参数时，直接取最后一段路径的扩展名
+            if not any(c in url_or_path for c in _URL_SPECIAL_CHARS):
+                dot = url_or_path.rfind(".")
+                slash = url_or_path.rfind("/")
+                scheme_end = url_or_path.find("://")
+                if dot > slash and (scheme_end < 0 or slash > scheme_end + 2):
+                    ext = url_or_path[dot:].lower()
+                    if ext in FileUtils.SUPPORTED_FORMATS:
+                        return ext
+
             parsed = urlparse(url_or_path)
             path = parsed.path
-            match = re.search(r"\.([a-zA-Z0-9]+)$", path)
+            match = _EXT_RE.search(path)
             if match:
                 ext = f".{match.group(1).lower()}"
                 if ext in FileUtils.SUPPORTED_FORMATS:
                     return ext
+            if not parsed.query:
+                return None
             query_params = parse_qs(parsed.query)
             for param_name in ["format", "type", "ext"]:
                 if param_name in query_params:
@@ -67,7 +83,7 @@ class FileUtils:
     @staticmethod
     def generate_filename(original_url: str, prefix: str) -> str:
         if len(original_url) > FileUtils.URL_LENGTH_THRESHOLD:
-            content_hash = hashlib.md5(original_url.encode()).hexdigest()[:16]
+            content_hash = hashlib.blake2b(original_url.encode(), digest_size=8).hexdigest()
             hash_input = f"{content_hash}_{prefix}"
         else:
             hash_input = f"{original_url}_{prefix}"
@@ -75,7 +91,7 @@ class FileUtils:
         timestamp = int(time_module.time())
         random_token = secrets.token_hex(4)
         hash_input = f"{hash_input}_{timestamp}_{random_token}"
-        file_hash = hashlib.sha256(hash_input.encode()).hexdigest()[:12]
+        file_hash = hashlib.blake2b(hash_input.encode(), digest_size=6).hexdigest()
 
         ext = FileUtils.get_file_extension(original_url) or ".png"
         filename = f"{prefix}_{file_hash}{ext}"
@@ -118,18 +134,9 @@ class FileUtils:
         if len(data) < 12:
             return None
 
-        magic = FileUtils.MAGIC_BYTES
-
-        if data[:6] in magic["gif"][0]:
-            return ".gif"
-        if data[:8] == magic["png"][0]:
-            return ".png"
-        if data[:3] == magic["jpeg"][0]:
-            return ".jpg"
-        if data[:4] == magic["webp"][0] and data[8:12] == magic["webp"][2]:
-            return ".webp"
-        if data[:2] == magic["bmp"][0]:
-            return ".bmp"
+        for prefix, ext, extra in FileUtils.MAGIC_BYTES:
+            if data.startswith(prefix) and (extra is None or data.startswith(extra[1], extra[0])):
+                return ext
 
         return None
 
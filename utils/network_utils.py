@@ -3,10 +3,13 @@
 """
 
 import asyncio
+import re
 import socket
+import time
+from io import BytesIO
 import ipaddress
 from typing import Optional, Tuple, Dict
-from urllib.parse import urlparse
+from urllib.parse import ParseResult, urlparse
 from astrbot.api import logger
 
 import aiohttp
@@ -16,8 +19,8 @@ class FixedDNSResolver:
     """固定DNS解析器，防止DNS重绑定攻击"""
 
     def __init__(self, safe_resolutions: Dict[str, str]):
+        # 与NetworkUtils共享同一个字典，每次请求前更新对应主机名的固定IP
         self._safe_resolutions = safe_resolutions
-        self._resolver = aiohttp.resolver.DefaultResolver()
 
     async def resolve(self, hostname: str, port=0, family=socket.AF_INET):
         if hostname in self._safe_resolutions:
@@ -40,57 +43,109 @@ class FixedDNSResolver:
                 "proto": socket.IPPROTO_TCP,
                 "flags": socket.AI_NUMERICHOST,
             }]
-        return await self._resolver.resolve(hostname, port, family)
+        # 没有经过校验的主机名一律拒绝，不回退到系统DNS
+        raise OSError(f"主机名未通过安全校验: {hostname}")
+
+    async def close(self):
+        pass
+
+
+def _ipv4_mask_pairs(networks: Tuple[str, ...]) -> Tuple[Tuple[int, int], ...]:
+    pairs = []
+    for cidr in networks:
+        net = ipaddress.IPv4Network(cidr)
+        pairs.append((int(net.network_address), int(net.netmask)))
+    return tuple(pairs)
 
 
 class NetworkUtils:
     """网络请求工具类"""
 
-    DANGEROUS_PATTERNS = [
-        "localhost",
-        "127.0.0.1",
-        "0.0.0.0",
-        "::1",
-        "169.254.",
-        "metadata.",
-        ".internal",
-        ".local",
-        ".localdomain",
-        "10.",
-        "172.16.",
-        "172.17.",
-        "172.18.",
-        "172.19.",
-        "172.20.",
-        "172.21.",
-        "172.22.",
-        "172.23.",
-        "172.24.",
-        "172.25.",
-        "172.26.",
-        "172.27.",
-        "172.28.",
-        "172.29.",
-        "172.30.",
-        "172.31.",
-        "192.168.",
-    ]
+    # 覆盖ipaddress的is_private/is_loopback/is_link_local对IPv4判定的范围
+    PRIVATE_IPV4_NETWORKS = _ipv4_mask_pairs((
+        "0.0.0.0/8",
+        "10.0.0.0/8",
+        "127.0.0.0/8",
+        "169.254.0.0/16",
+        "172.16.0.0/12",
+        "192.0.0.0/24",
+        "192.0.2.0/24",
+        "192.168.0.0/16",
+        "198.18.0.0/15",
+        "198.51.100.0/24",
+        "203.0.113.0/24",
+        "240.0.0.0/4",
+        "255.255.255.255/32",
+    ))
+
+    # 危险主机名：以下列模式开头，或以"."+模式结尾
+    # （模式：localhost/metadata./.internal/.local/.localdomain、回环地址、内网IP段前缀）
+    DANGEROUS_HOST_RE = re.compile(
+        r"^(?:localhost|metadata\.|\.internal|\.local|127\.0\.0\.1|0\.0\.0\.0|::1"
+        r"|169\.254\.|10\.|172\.(?:1[6-9]|2[0-9]|3[01])\.|192\.168\.)"
+        r"|(?:^|\.)(?:localhost|internal|local|localdomain|metadata\.|127\.0\.0\.1|0\.0\.0\.0|::1"
+        r"|169\.254\.|10\.|172\.(?:1[6-9]|2[0-9]|3[01])\.|192\.168\.)$"
+    )
+
+    MAX_PINNED_HOSTS = 256
+    SAFE_HOST_CACHE_TTL = 300
+    MAX_SAFE_HOST_CACHE = 256
 
     def __init__(self, timeout: int = 30, max_size: int = 10 * 1024 * 1024):
         self.timeout = timeout
         self.max_size = max_size
         self._session: Optional[aiohttp.ClientSession] = None
         self._session_lock = asyncio.Lock()
+        self._pinned_ips: Dict[str, str] = {}
+        self._pin_refs: Dict[str, int] = {}
+        self._safe_host_cache: Dict[str, Tuple[str, float]] = {}
+        self._resolve_tasks: Dict[str, "asyncio.Future[Optional[str]]"] = {}
 
     async def _get_session(self) -> aiohttp.ClientSession:
         if self._session is None or self._session.closed:
             async with self._session_lock:
                 if self._session is None or self._session.closed:
+                    # 解析结果始终以_pinned_ips为准，所以关闭连接器自身的DNS缓存
+                    connector = aiohttp.TCPConnector(
+                        resolver=FixedDNSResolver(self._pinned_ips),
+                        limit_per_host=3,
+                        use_dns_cache=False,
+                        keepalive_timeout=60,
+                    )
                     timeout = aiohttp.ClientTimeout(total=self.timeout)
-                    self._session = aiohttp.ClientSession(timeout=timeout)
+                    # 会话在不同用户的下载之间共享，不保存Cookie，避免一个图床设置的Cookie被带到别人的请求里
+                    self._session = aiohttp.ClientSession(
+                        connector=connector,
+                        timeout=timeout,
+                        cookie_jar=aiohttp.DummyCookieJar(),
+                    )
         return self._session
 
+    def _pin_hostname(self, hostname: str, safe_ip: str):
+        """记录主机名对应的已校验IP，供共享会话的解析器使用；请求结束前该记录不会被淘汰"""
+        self._pin_refs[hostname] = self._pin_refs.get(hostname, 0) + 1
+        self._pinned_ips.pop(hostname, None)
+        self._pinned_ips[hostname] = safe_ip
+        if len(self._pinned_ips) > self.MAX_PINNED_HOSTS:
+            for old_hostname in self._pinned_ips:
+                if old_hostname not in self._pin_refs:
+                    del self._pinned_ips[old_hostname]
+                    break
+
+    def _unpin_hostname(self, hostname: str):
+        refs = self._pin_refs.get(hostname, 0) - 1
+        if refs > 0:
+            self._pin_refs[hostname] = refs
+        else:
+            self._pin_refs.pop(hostname, None)
+
     def _is_private_ip(self, ip_str: str) -> bool:
+        if ":" not in ip_str:
+            try:
+                ip_int = int.from_bytes(socket.inet_aton(ip_str), "big")
+            except OSError:
+                return False
+            return any(ip_int & mask == net for net, mask in self.PRIVATE_IPV4_NETWORKS)
         try:
             ip = ipaddress.ip_address(ip_str)
             return ip.is_private or ip.is_loopback or ip.is_link_local
@@ -98,6 +153,9 @@ class NetworkUtils:
             return False
 
     def _is_ip_format(self, hostname: str) -> bool:
+        # 既不以数字开头也不含冒号的主机名不可能是IP，跳过ipaddress解析
+        if not hostname or not (hostname[0].isdigit() or ":" in hostname):
+            return False
         try:
             ipaddress.ip_address(hostname)
             return True
@@ -135,9 +193,49 @@ class NetworkUtils:
             logger.debug(f"DNS解析失败 {hostname}: {e}")
         return None
 
-    async def _is_safe_url_with_ip(self, url: str) -> Optional[Tuple[str, str]]:
+    def _cache_safe_host(self, hostname: str, safe_ip: str):
+        """缓存已通过校验的解析结果，短时间内重复下载同一主机时跳过DNS"""
+        self._safe_host_cache.pop(hostname, None)
+        self._safe_host_cache[hostname] = (safe_ip, time.monotonic() + self.SAFE_HOST_CACHE_TTL)
+        if len(self._safe_host_cache) > self.MAX_SAFE_HOST_CACHE:
+            self._safe_host_cache.pop(next(iter(self._safe_host_cache)))
+
+    def _get_cached_safe_ip(self, hostname: str) -> Optional[str]:
+        cached = self._safe_host_cache.get(hostname)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    async def _resolve_and_check(self, hostname: str) -> Optional[str]:
+        resolved_ip = await self._resolve_hostname(hostname)
+        if not resolved_ip or self._is_private_ip(resolved_ip):
+            return None
+        self._cache_safe_host(hostname, resolved_ip)
+        return resolved_ip
+
+    async def _resolve_safe_ip(self, hostname: str) -> Optional[str]:
+        """解析主机名并校验为公网IP；同一主机的并发请求共享同一次解析的结果（包括失败）"""
+        safe_ip = self._get_cached_safe_ip(hostname)
+        if safe_ip:
+            return safe_ip
+
+        task = self._resolve_tasks.get(hostname)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve_and_check(hostname))
+            self._resolve_tasks[hostname] = task
+
+            def _forget(done: asyncio.Future, hostname: str = hostname):
+                if self._resolve_tasks.get(hostname) is done:
+                    del self._resolve_tasks[hostname]
+
+            task.add_done_callback(_forget)
+        # shield: 某个等待者被取消时不影响其他共享这次解析的请求
+        return await asyncio.shield(task)
+
+    async def _is_safe_url_with_ip(self, url: str, parsed: Optional[ParseResult] = None) -> Optional[Tuple[str, str]]:
         try:
-            parsed = urlparse(url)
+            if parsed is None:
+                parsed = urlparse(url)
             if parsed.scheme not in ("http", "https"):
                 return None
             hostname = parsed.hostname
@@ -156,17 +254,11 @@ class NetworkUtils:
                         return None
                     return (hostname_clean, hostname)
 
-            for pattern in self.DANGEROUS_PATTERNS:
-                clean_pattern = pattern[1:] if pattern.startswith(".") else pattern
-                if (hostname == pattern or hostname.endswith("." + clean_pattern) or
-                        hostname.startswith(pattern)):
-                    return None
-
-            resolved_ip = await self._resolve_hostname(hostname)
-            if not resolved_ip:
+            if self.DANGEROUS_HOST_RE.search(hostname):
                 return None
 
-            if self._is_private_ip(resolved_ip):
+            resolved_ip = await self._resolve_safe_ip(hostname)
+            if not resolved_ip:
                 return None
 
             return (resolved_ip, hostname)
@@ -174,41 +266,50 @@ class NetworkUtils:
             logger.warning(f"URL安全检查失败 {url}: {e}")
             return None
 
-    async def download_image(self, url: str) -> Optional[bytes]:
+    async def download_image(self, url: str) -> Optional[BytesIO]:
         """下载图片（防SSRF版本）"""
-        safe_info = await self._is_safe_url_with_ip(url)
+        try:
+            parsed = urlparse(url)
+        except ValueError:
+            logger.warning(f"无法解析的URL: {url}")
+            return None
+
+        safe_info = await self._is_safe_url_with_ip(url, parsed)
         if not safe_info:
             logger.warning(f"拒绝不安全的URL: {url}")
             return None
 
         safe_ip, hostname = safe_info
 
+        self._pin_hostname(hostname, safe_ip)
         try:
-            resolver = FixedDNSResolver({hostname: safe_ip})
-            connector = aiohttp.TCPConnector(
-                resolver=resolver,
-                limit_per_host=3,
-                ttl_dns_cache=300,
-            )
-            timeout = aiohttp.ClientTimeout(total=self.timeout)
-
-            async with aiohttp.ClientSession(
-                connector=connector, timeout=timeout
-            ) as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        logger.error(f"下载失败，状态码: {response.status}")
+            session = await self._get_session()
+
+            async with session.get(url) as response:
+                if response.status != 200:
+                    logger.error(f"下载失败，状态码: {response.status}")
+                    return None
+
+                if response.content_length and response.content_length > self.max_size:
+                    logger.error(f"图片超过大小限制: {response.content_length} bytes")
+                    return None
+
+                buffer = BytesIO()
+                total = 0
+                async for chunk in response.content.iter_chunked(8192):
+                    total += len(chunk)
+                    if total > self.max_size:
+                        logger.error(f"图片超过大小限制: {total} bytes")
                         return None
+                    buffer.write(chunk)
 
-                    buffer = bytearray()
-                    async for chunk in response.content.iter_chunked(8192):
-                        buffer.extend(chunk)
-                        if len(buffer) > self.max_size:
-                            logger.error(f"图片超过大小限制: {len(buffer)} bytes")
-                            return None
+                if total == 0:
+                    logger.error(f"下载的图片为空: {url}")
+                    return None
 
-                    logger.info(f"成功下载图片，大小: {len(buffer)} bytes")
-                    return bytes(buffer)
+                logger.info(f"成功下载图片，大小: {total} bytes")
+                buffer.seek(0)
+                return buffer
 
         except asyncio.TimeoutError:
             logger.error(f"下载超时: {url}")
@@ -216,6 +317,8 @@ class NetworkUtils:
         except Exception as e:
             logger.error(f"下载图片失败 {url}: {str(e)}")
             return None
+        finally:
+            self._unpin_hostname(hostname)
 
     async def cleanup(self):
         if self._session and not self._session.closed: